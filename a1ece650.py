@@ -1,39 +1,66 @@
 from __future__ import print_function
 
+import argparse
+import json
+import numbers
 import sys
 
 from graph import Graph
-from street import Street
-from parse import parse
+from intersection_cache import IntersectionCache
+from memory import MemoryAccounting
+from street import Point, Street
+from parse import is_valid_street_name, parse
+
+# the maximum number of bytes to use to remember the intersections of pairs
+# of streets
+INTERSECTION_CACHE_SIZE = 4 * 1024 * 1024
 
 streets = {}
 graph = Graph()
+intersection_cache = IntersectionCache(INTERSECTION_CACHE_SIZE)
+
+# the commands queued in the currently open batch, None if no batch is open
+batch = None
+
+# memory accounting and budget, None if it is disabled
+memory = None
 
 
 def throw_error(msg):
     print("Error: %s" % msg, file=sys.stderr)
 
 
-def add_street(street_name, coordinates):
-    # check for any errors in the input
+def check_add_street(street_names, street_name, coordinates):
+    # check for any errors in the input, returns the error message if there is
+    # one, street_names are the names of the streets currently in the database
     if not street_name:
-        return throw_error('A valid street name is required to add a street.')
-    elif street_name in streets:
-        return throw_error('Trying to add a street that already exists.')
+        return 'A valid street name is required to add a street.'
+    elif street_name in street_names:
+        return 'Trying to add a street that already exists.'
     elif not coordinates or len(coordinates) < 2:
-        return throw_error('A street needs to have 2 or more points.')
+        return 'A street needs to have 2 or more points.'
+
+
+def add_street(street_name, coordinates):
+    # check for any errors in the input
+    error = check_add_street(streets, street_name, coordinates)
+    if error:
+        return throw_error(error)
 
     # add the street
     base_add_street(street_name, coordinates)
 
 
-def base_add_street(street_name, coordinates):
+def base_add_street(street_name, coordinates, use_cache=True):
     # create the street
     new_street = Street(street_name, coordinates)
 
     # check for any intersections with the existing streets
     for street in streets.values():
-        intersections = street.find_intersections(new_street)
+        if use_cache:
+            intersections = intersection_cache.find_intersections(street, new_street)
+        else:
+            intersections = street.find_intersections(new_street)
 
         # add the intersections to the graph
         for intersection in intersections:
@@ -43,14 +70,22 @@ def base_add_street(street_name, coordinates):
     streets[street_name] = new_street
 
 
-def change_street(street_name, new_coordinates):
-    # check for any errors in the input
+def check_change_street(street_names, street_name, new_coordinates):
+    # check for any errors in the input, returns the error message if there is
+    # one, street_names are the names of the streets currently in the database
     if not street_name:
-        return throw_error('A valid street name is required to change a street.')
-    elif street_name not in streets:
-        return throw_error('Trying to change a street that does not exist.')
+        return 'A valid street name is required to change a street.'
+    elif street_name not in street_names:
+        return 'Trying to change a street that does not exist.'
     elif not new_coordinates or len(new_coordinates) < 2:
-        return throw_error('A street needs to have 2 or more points.')
+        return 'A street needs to have 2 or more points.'
+
+
+def change_street(street_name, new_coordinates):
+    # check for any errors in the input
+    error = check_change_street(streets, street_name, new_coordinates)
+    if error:
+        return throw_error(error)
 
     # change the street
     base_change_street(street_name, new_coordinates)
@@ -63,14 +98,22 @@ def base_change_street(street_name, new_coordinates):
     base_add_street(street_name, new_coordinates)
 
 
-def remove_street(street_name, coordinates):
-    # check for any errors in the input
+def check_remove_street(street_names, street_name, coordinates):
+    # check for any errors in the input, returns the error message if there is
+    # one, street_names are the names of the streets currently in the database
     if not street_name:
-        return throw_error('A valid street name is required to remove a street.')
-    elif street_name not in streets:
-        return throw_error('Trying to remove a street that does not exist.')
+        return 'A valid street name is required to remove a street.'
+    elif street_name not in street_names:
+        return 'Trying to remove a street that does not exist.'
     elif coordinates:
-        return throw_error('Received coordinates for a street that is being removed.')
+        return 'Received coordinates for a street that is being removed.'
+
+
+def remove_street(street_name, coordinates):
+    # check for any errors in the input
+    error = check_remove_street(streets, street_name, coordinates)
+    if error:
+        return throw_error(error)
 
     # remove the street
     base_remove_street(street_name, coordinates)
@@ -92,6 +135,226 @@ def generate_graph(street_name, coordinates):
     print(graph)
 
 
+def print_vertices(vertices):
+    # output the vertices in the same format as the graph
+    output = 'V = {\n'
+    for vertex in vertices:
+        output += '  %s\n' % vertex
+    print(output + '}')
+
+
+def query_range(street_name, coordinates):
+    # check for any errors in the input
+    if street_name:
+        return throw_error('Did not expect a street name for this command.')
+    elif len(coordinates) != 2:
+        return throw_error('A range query needs exactly 2 points.')
+
+    print_vertices(graph.find_in_range(coordinates[0], coordinates[1]))
+
+
+def query_nearest(street_name, coordinates):
+    # check for any errors in the input
+    if street_name:
+        return throw_error('Did not expect a street name for this command.')
+    elif len(coordinates) != 1:
+        return throw_error('A nearest vertex query needs exactly 1 point.')
+
+    vertex = graph.find_nearest(coordinates[0])
+    print_vertices([vertex] if vertex else [])
+
+
+def begin_batch(street_name, coordinates):
+    global batch
+
+    # check for any errors in the input
+    if street_name:
+        return throw_error('Did not expect a street name for this command.')
+    elif coordinates:
+        return throw_error('Did not expect coordinates for this command.')
+    elif batch is not None:
+        return throw_error('A batch is already in progress.')
+
+    # start queueing the commands
+    batch = []
+
+
+def end_batch(street_name, coordinates):
+    global batch
+
+    # check for any errors in the input
+    if street_name:
+        return throw_error('Did not expect a street name for this command.')
+    elif coordinates:
+        return throw_error('Did not expect coordinates for this command.')
+    elif batch is None:
+        return throw_error('Trying to end a batch that was never started.')
+
+    # close the batch before applying it, so it is not left open on an error
+    commands = batch
+    batch = None
+    apply_batch(commands)
+
+
+def apply_batch(commands):
+    checks = {
+        'a': check_add_street,
+        'c': check_change_street,
+        'r': check_remove_street
+    }
+
+    """
+    Validate all of the commands before changing anything. The commands are
+    checked in order against the street names as they would be after each of
+    the previous commands, if any command is invalid, none of the commands in
+    the batch are applied (the batch is rolled back)
+
+    The graph depends on the order of the changes made to it (even streets
+    that are added and then removed again can leave a trace), so the changes
+    are applied in the order of the commands to give the same graph as
+    running them one at a time. A change is a removal and then an addition
+    """
+    street_names = set(streets)
+    changes = []
+    for action, street_name, coordinates in commands:
+        error = checks[action](street_names, street_name, coordinates)
+        if error:
+            return throw_error('%s The batch was rolled back.' % error)
+
+        if action in ['c', 'r']:
+            changes.append((street_name, None))
+        if action in ['a', 'c']:
+            changes.append((street_name, coordinates))
+
+        if action == 'r':
+            street_names.remove(street_name)
+        else:
+            street_names.add(street_name)
+
+    base_apply_batch(changes)
+
+
+def is_over_memory_budget():
+    # only refuse new streets when the budget is exceeded if configured to,
+    # otherwise just warn about it
+    return memory is not None and memory.is_over_budget(streets, graph, intersection_cache) \
+        and memory.refuse
+
+
+def check_memory_budget(action):
+    """
+    Check the memory budget before a command that adds streets, i.e. `a` or
+    ending a batch with an `a` in it. Returns the error message if the
+    command is refused. This is done before measuring the memory used by the
+    command, so measuring the size of the database is not counted in it
+    """
+    global batch
+
+    if action == 'a' and batch is None:
+        if is_over_memory_budget():
+            return 'The memory budget is exceeded, the street was not added.'
+    elif action == 'e' and batch is not None \
+            and any(command[0] == 'a' for command in batch):
+        if is_over_memory_budget():
+            batch = None
+            return 'The memory budget is exceeded, the batch was rolled back.'
+
+
+def base_apply_batch(changes, use_cache=True):
+    """
+    Apply a list of (street name, coordinates) changes in order, coordinates
+    of None removes the street and otherwise adds it. Consecutive removals
+    are done together, with a single sanitization of the graph
+    """
+    removed = []
+    for street_name, coordinates in changes:
+        if coordinates is None:
+            removed.append(street_name)
+            continue
+
+        base_remove_streets(removed)
+        removed = []
+        base_add_street(street_name, coordinates, use_cache)
+
+    base_remove_streets(removed)
+
+
+def base_remove_streets(street_names):
+    # remove the streets from the graph and database
+    if not street_names:
+        return
+
+    graph.remove_streets(street_names)
+    for street_name in street_names:
+        del streets[street_name]
+
+
+def load_map(path):
+    """
+    Load a map directly from a file of JSON lines, bypassing the command
+    parser, e.g.
+        {"name": "Weber Street", "coordinates": [[2, -1], [2, 2], [5, 5]]}
+    The street names and coordinates are restricted to what could be given
+    in a command. Invalid lines are reported and skipped, the valid streets
+    are all added to the graph at once
+    """
+    street_names = set(streets)
+    changes = []
+    with open(path) as map_file:
+        for line_number, line in enumerate(map_file, 1):
+            line = line.strip()
+            if not line:
+                continue
+
+            try:
+                entry = json.loads(line)
+                # street names are case insensitive, see parse
+                street_name = entry['name'].lower()
+                points = [(x, y) for x, y in entry['coordinates']]
+            except (ValueError, TypeError, KeyError, AttributeError):
+                throw_error('Could not parse line %d of the map.' % line_number)
+                continue
+
+            if not is_valid_street_name(street_name):
+                throw_error(
+                    'Street names can only contain letters, numbers, '
+                    'underscores and spaces. (line %d of the map)' % line_number
+                )
+                continue
+            elif not all(is_integer(x) and is_integer(y) for x, y in points):
+                throw_error(
+                    'Coordinates must be integers. (line %d of the map)'
+                    % line_number
+                )
+                continue
+
+            coordinates = [Point(x, y) for x, y in points]
+
+            error = check_add_street(street_names, street_name, coordinates)
+            if error:
+                throw_error('%s (line %d of the map)' % (error, line_number))
+                continue
+
+            street_names.add(street_name)
+            changes.append((street_name, coordinates))
+
+    if changes and is_over_memory_budget():
+        return throw_error('The memory budget is exceeded, the map was not loaded.')
+
+    # every pair of streets in the map is only compared once, so caching the
+    # intersections would only fill (and churn) the cache
+    base_apply_batch(changes, use_cache=False)
+
+    # warn if loading the map went over the budget
+    if memory is not None:
+        memory.is_over_budget(streets, graph, intersection_cache)
+
+
+def is_integer(value):
+    # bool is a subclass of int, but true and false are not coordinates
+    return isinstance(value, numbers.Integral) and not isinstance(value, bool)
+
+
 def execute_command(command):
     # a command could not be parsed from the given line
     if not command:
@@ -102,11 +365,27 @@ def execute_command(command):
         'a': add_street,
         'c': change_street,
         'r': remove_street,
-        'g': generate_graph
+        'g': generate_graph,
+        'b': begin_batch,
+        'e': end_batch,
+        'q': query_range,
+        'n': query_nearest
     }
 
     action = command.get('action')
 
+    # while a batch is open, queue the street commands instead of executing
+    # them, they are validated and applied when the batch is ended
+    if batch is not None and action in ['a', 'c', 'r']:
+        batch.append((
+            action,
+            command.get('street_name'),
+            command.get('coordinates')
+        ))
+        return
+    elif batch is not None and action in ['g', 'q', 'n']:
+        return throw_error('Cannot query the graph while a batch is in progress.')
+
     # Should not reach this condition as we check for a valid command in
     # the parser
     if action not in valid_commands:
@@ -115,7 +394,20 @@ def execute_command(command):
         )
         return
 
-    # execute the command
+    error = check_memory_budget(action)
+    if error:
+        return throw_error(error)
+
+    # execute the command, measuring the memory it uses if enabled
+    if memory is not None:
+        memory.measure(
+            action,
+            valid_commands[action],
+            command.get('street_name'),
+            command.get('coordinates')
+        )
+        return
+
     valid_commands[action](
         command.get('street_name'),
         command.get('coordinates')
@@ -123,7 +415,68 @@ def execute_command(command):
 
 
 def main():
-    # YOUR MAIN CODE GOES HERE
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '--load-map',
+        metavar='FILE',
+        help='load the streets in FILE (JSON lines) before reading commands'
+    )
+    parser.add_argument(
+        '--memory-accounting',
+        action='store_true',
+        help='report the memory used by each type of command on exit'
+    )
+    parser.add_argument(
+        '--memory-budget',
+        metavar='BYTES',
+        type=int,
+        help='warn when the street database and graph use more than BYTES'
+    )
+    parser.add_argument(
+        '--refuse-over-budget',
+        action='store_true',
+        help='refuse to add streets once the memory budget is exceeded'
+    )
+    parser.add_argument(
+        '--intersection-cache-size',
+        metavar='BYTES',
+        type=int,
+        default=INTERSECTION_CACHE_SIZE,
+        help='the (estimated) memory used to cache the intersections of pairs '
+             'of streets, 0 disables the cache (default: %(default)s)'
+    )
+    parser.add_argument(
+        '--cache-stats',
+        action='store_true',
+        help='report the intersection cache hits, misses and evictions on exit'
+    )
+    parser.add_argument(
+        '--compact-ids',
+        action='store_true',
+        help='reuse the ids of removed vertices to keep the vertex ids dense'
+    )
+    args = parser.parse_args()
+
+    global graph
+    graph = Graph(compact_ids=args.compact_ids)
+
+    global intersection_cache
+    intersection_cache = IntersectionCache(max(args.intersection_cache_size, 0))
+
+    global memory
+    if args.memory_accounting or args.memory_budget is not None:
+        memory = MemoryAccounting(
+            track=args.memory_accounting,
+            budget=args.memory_budget,
+            refuse=args.refuse_over_budget
+        )
+
+    if args.load_map:
+        try:
+            load_map(args.load_map)
+        except IOError as e:
+            throw_error('Could not read the map: %s' % e)
+            sys.exit(1)
 
     # sample code to read from stdin.
     # make sure to remove all spurious print statements as required
@@ -134,6 +487,19 @@ def main():
             break
         execute_command(parse(line))
 
+    # the commands in a batch that was never ended are not applied
+    if batch is not None:
+        throw_error(
+            'The batch was never ended, %d queued command(s) were not applied.'
+            % len(batch)
+        )
+
+    if args.memory_accounting:
+        memory.report(streets, graph, intersection_cache)
+
+    if args.cache_stats or args.memory_accounting:
+        print(intersection_cache.report(), file=sys.stderr)
+
     # return exit code 0 on successful termination
     sys.exit(0)
 
@@ -0,0 +1,390 @@
+"""
+Differential fuzzer, generates random streams of commands and runs them
+through the reference implementation (searching every vertex, no
+intersection cache) and through each of the faster engines, checking that
+the output is identical. A failing stream is shrunk to a minimal sequence
+of commands that still produces different output.
+
+Exceptions are not part of the output, a stream that makes the reference
+implementation raise is reported (and shrunk) as a crash. The engines are
+still compared to it, they have to crash with the same exception after the
+same output.
+
+Usage: python fuzz.py [--runs N] [--commands N] [--seed N]
+"""
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import random
+import re
+import sys
+import tempfile
+import time
+
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+import a1ece650
+from graph import Graph
+from intersection_cache import IntersectionCache
+from parse import parse
+
+
+def same_output(output):
+    return output
+
+
+def without_ids(output):
+    """
+    Replace the vertex ids in the output by the coordinates of the vertices,
+    for engines that number the vertices differently. The vertices in each
+    block of output are sorted, since queries output them ordered by id
+    """
+    lines = []
+    block = []
+    ids = {}
+    for line in output.splitlines():
+        vertex = re.match(r'  (\d+): (\(.*\))$', line)
+        edge = re.match(r'  <(\d+),(\d+)>,?$', line)
+        if vertex:
+            ids[vertex.group(1)] = vertex.group(2)
+            block.append('  %s' % vertex.group(2))
+            continue
+
+        lines += sorted(block)
+        block = []
+        if edge:
+            # an edge can still reference a vertex that was removed from V
+            lines.append('  <%s,%s>' % (
+                ids.get(edge.group(1), 'removed'),
+                ids.get(edge.group(2), 'removed')
+            ))
+        else:
+            lines.append(line)
+            # the ids are only valid within the output of one `g`
+            if line == 'V = {':
+                ids = {}
+
+    return '\n'.join(lines + sorted(block))
+
+
+def final_graph(output):
+    # only the graph output by the `g` at the end of the stream
+    start = output.rfind('V = {\n')
+    return output[start:] if start >= 0 else ''
+
+
+"""
+Each engine has:
+    create - a function creating a fresh (graph, intersection cache)
+    normalize - applied to the output before comparing it to the reference
+    load_map - if the leading `a` commands of the stream are loaded with
+               --load-map instead of being run as commands
+    batch - if the valid `a`, `c` and `r` commands of the stream are run as
+            one batch instead, only the final graph (or the exception) can be
+            compared then. It runs fewer commands, so its time is not
+            comparable to the others
+"""
+ENGINES = {
+    'reference': {
+        'create': lambda: (Graph(use_index=False), IntersectionCache(0)),
+        'normalize': same_output,
+        'load_map': False,
+        'batch': False
+    },
+    'fast': {
+        'create': lambda: (
+            Graph(), IntersectionCache(a1ece650.INTERSECTION_CACHE_SIZE)
+        ),
+        'normalize': same_output,
+        'load_map': False,
+        'batch': False
+    },
+    'compact-ids': {
+        'create': lambda: (
+            Graph(compact_ids=True),
+            IntersectionCache(a1ece650.INTERSECTION_CACHE_SIZE)
+        ),
+        'normalize': without_ids,
+        'load_map': False,
+        'batch': False
+    },
+    'load-map': {
+        'create': lambda: (
+            Graph(), IntersectionCache(a1ece650.INTERSECTION_CACHE_SIZE)
+        ),
+        'normalize': same_output,
+        'load_map': True,
+        'batch': False
+    },
+    'batch': {
+        'create': lambda: (
+            Graph(), IntersectionCache(a1ece650.INTERSECTION_CACHE_SIZE)
+        ),
+        'normalize': final_graph,
+        'load_map': False,
+        'batch': True
+    }
+}
+
+STREET_NAMES = ['a', 'b', 'c', 'd', 'e']
+
+# keep the coordinates in a small range so that streets often share
+# endpoints, overlap and are parallel
+COORD_RANGE = 4
+
+
+def random_point(rng, coord_range=COORD_RANGE):
+    return '(%d,%d)' % (
+        rng.randint(-coord_range, coord_range),
+        rng.randint(-coord_range, coord_range)
+    )
+
+
+def random_coordinates(rng):
+    return ' '.join(random_point(rng) for i in range(rng.randint(2, 4)))
+
+
+def random_command(rng):
+    # the commands can be invalid (i.e. adding a street that exists) to
+    # exercise the error handling as well
+    action = rng.choice('aaaccrrgqn')
+    if action == 'g':
+        return 'g'
+    elif action == 'q':
+        return 'q %s %s' % (random_point(rng), random_point(rng))
+    elif action == 'n':
+        # sometimes query far away from all of the streets
+        return 'n %s' % random_point(rng, rng.choice([COORD_RANGE, 1000]))
+
+    street_name = rng.choice(STREET_NAMES)
+    if action == 'r':
+        return 'r "%s"' % street_name
+
+    return '%s "%s" %s' % (action, street_name, random_coordinates(rng))
+
+
+def random_commands(rng, count):
+    # start with a few streets, so that the --load-map path has something
+    # to load
+    names = rng.sample(STREET_NAMES, rng.randint(0, len(STREET_NAMES)))
+    commands = [
+        'a "%s" %s' % (street_name, random_coordinates(rng))
+        for street_name in names
+    ]
+    return commands + [random_command(rng) for i in range(count)]
+
+
+def split_map(commands):
+    """
+    Split off the leading `a` commands that can be loaded as a map, i.e.
+    adding streets that were not added before, returning them as map lines
+    and the rest of the commands
+    """
+    lines = []
+    names = set()
+    for i, line in enumerate(commands):
+        command = parse(line)
+        if (not command or command['action'] != 'a'
+                or command['street_name'] in names):
+            return lines, commands[i:]
+
+        names.add(command['street_name'])
+        lines.append(json.dumps({
+            'name': command['street_name'],
+            'coordinates': [
+                [int(p.x), int(p.y)] for p in command['coordinates']
+            ]
+        }))
+
+    return lines, []
+
+
+def to_batch(commands):
+    """
+    Wrap the `a`, `c` and `r` commands that are valid (given the commands
+    before them) in a batch, the other commands don't change the graph
+    """
+    checks = {
+        'a': a1ece650.check_add_street,
+        'c': a1ece650.check_change_street,
+        'r': a1ece650.check_remove_street
+    }
+
+    names = set()
+    batch = []
+    for line in commands:
+        command = parse(line)
+        if not command or command['action'] not in checks:
+            continue
+
+        action = command['action']
+        street_name = command['street_name']
+        if checks[action](names, street_name, command['coordinates']):
+            continue
+
+        if action == 'r':
+            names.remove(street_name)
+        else:
+            names.add(street_name)
+        batch.append(line)
+
+    return ['b'] + batch + ['e']
+
+
+def load_map(lines):
+    fd, path = tempfile.mkstemp()
+    try:
+        with os.fdopen(fd, 'w') as map_file:
+            map_file.write('\n'.join(lines))
+        a1ece650.load_map(path)
+    finally:
+        os.remove(path)
+
+
+def run(engine, commands):
+    """
+    Run the commands through the given engine, returning the (normalized)
+    output, the time it took and the exception the engine crashed with, if
+    it did. Nothing is run after a crash
+    """
+    graph, intersection_cache = ENGINES[engine]['create']()
+    a1ece650.streets = {}
+    a1ece650.graph = graph
+    a1ece650.intersection_cache = intersection_cache
+    a1ece650.batch = None
+
+    map_lines = []
+    if ENGINES[engine]['load_map']:
+        map_lines, commands = split_map(commands)
+    if ENGINES[engine]['batch']:
+        commands = to_batch(commands)
+
+    output = StringIO()
+    crash = None
+    stdout, stderr = sys.stdout, sys.stderr
+    sys.stdout = sys.stderr = output
+    try:
+        start = time.time()
+        try:
+            if map_lines:
+                load_map(map_lines)
+            # always output the graph at the end to compare the final state
+            for line in commands + ['g']:
+                a1ece650.execute_command(parse(line))
+        except Exception as e:
+            crash = '%s: %s' % (type(e).__name__, e)
+        elapsed = time.time() - start
+    finally:
+        sys.stdout, sys.stderr = stdout, stderr
+
+    return ENGINES[engine]['normalize'](output.getvalue()), elapsed, crash
+
+
+def same_result(engine, expected, result):
+    """
+    Compare the result of running a stream through the engine to the result
+    of the reference implementation, both (output, elapsed, crash)
+    """
+    if expected[2] != result[2]:
+        return False
+    # a batch is applied all at once, so when it crashes, there is no output
+    # from the commands before the crash to compare
+    if expected[2] and ENGINES[engine]['batch']:
+        return True
+    # the outputs are normalized for the engine being compared
+    return ENGINES[engine]['normalize'](expected[0]) == result[0]
+
+
+def differs(engine, commands):
+    return not same_result(
+        engine, run('reference', commands), run(engine, commands)
+    )
+
+
+def crashes(commands):
+    return run('reference', commands)[2] is not None
+
+
+def shrink(commands, fails):
+    """
+    Remove chunks of commands, starting with halves and going down to single
+    commands, for as long as the commands still fail
+    """
+    chunk = len(commands) // 2
+    while chunk > 0:
+        i = 0
+        while i < len(commands):
+            candidate = commands[:i] + commands[i + chunk:]
+            if fails(candidate):
+                commands = candidate
+            else:
+                i += chunk
+        chunk //= 2
+    return commands
+
+
+def print_commands(commands):
+    for line in commands:
+        print('  %s' % line)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--runs', type=int, default=100)
+    parser.add_argument('--commands', type=int, default=50)
+    parser.add_argument('--seed', type=int, default=None)
+    args = parser.parse_args()
+
+    seed = args.seed if args.seed is not None else random.randrange(2 ** 32)
+    print('seed: %d' % seed)
+    rng = random.Random(seed)
+
+    engines = [engine for engine in sorted(ENGINES) if engine != 'reference']
+    total_time = dict((engine, 0.0) for engine in ENGINES)
+    failures = 0
+    crash_count = 0
+
+    for i in range(args.runs):
+        commands = random_commands(rng, args.commands)
+        expected = run('reference', commands)
+        total_time['reference'] += expected[1]
+
+        if expected[2]:
+            crash_count += 1
+            print('run %d: the reference crashed with `%s`, shrunk to:'
+                  % (i, expected[2]))
+            print_commands(shrink(commands, crashes))
+
+        for engine in engines:
+            result = run(engine, commands)
+            total_time[engine] += result[1]
+
+            if not same_result(engine, expected, result):
+                failures += 1
+                crash = result[2]
+                print('run %d: `%s` differs from the reference%s, shrunk to:'
+                      % (i, engine, ' (crashed with `%s`)' % crash if crash else ''))
+                print_commands(shrink(
+                    commands, lambda c, engine=engine: differs(engine, c)
+                ))
+
+    for engine in engines:
+        print('%s: %.3fs, %.2fx speedup over the reference (%.3fs)' % (
+            engine,
+            total_time[engine],
+            total_time['reference'] / max(total_time[engine], 1e-9),
+            total_time['reference']
+        ))
+    print('%d failure(s) and %d crash(es) of the reference in %d run(s)'
+          % (failures, crash_count, args.runs))
+
+    sys.exit(1 if failures or crash_count else 0)
+
+
+if __name__ == '__main__':
+    main()
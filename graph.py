@@ -1,8 +1,11 @@
-class Vertex(object):
-    # static variable to ensure that each vertex has a unique
-    next_id = 0
+import heapq
+
+from spatial_index import GridIndex
+from street import POS_EPSILON
 
-    def __init__(self, pos, is_intersection, is_endpoint):
+
+class Vertex(object):
+    def __init__(self, vertex_id, pos, is_intersection, is_endpoint):
         # the position of the vertex
         self.coordinates = pos
 
@@ -11,10 +14,8 @@ class Vertex(object):
         self.is_intersection = is_intersection
         self.is_endpoint = is_endpoint
 
-        # properly store the id and ensure the next vertex created has a
-        # proper id
-        self.id = Vertex.next_id
-        Vertex.next_id += 1
+        # the id is allocated by the graph the vertex belongs to
+        self.id = vertex_id
 
     def add_street(self, street_name):
         # avoid adding the same street twice
@@ -48,6 +49,9 @@ class Vertex(object):
     def get_id(self):
         return self.id
 
+    def set_id(self, vertex_id):
+        self.id = vertex_id
+
     def is_equal_to_point(self, p):
         # check if this vertex lies on, or approximately on, the given point
         return self.coordinates.is_equal_to_point(p)
@@ -70,16 +74,108 @@ def get_x(vertex):
 
 
 class Graph(object):
-    def __init__(self):
+    def __init__(self, compact_ids=False, use_index=True):
         self.vertices = {}
         self.edges = {}
 
+        # each graph allocates its own vertex ids. By default the ids only ever
+        # grow, in compact mode the ids of removed vertices are reused (lowest
+        # first) to keep the ids dense
+        self.compact_ids = compact_ids
+        self.next_id = 0
+        self.free_ids = []
+
+        # vertices removed in compact mode whose ids have not been reused yet,
+        # see release_ids
+        self.removed = []
+
+        # spatial index over the vertices, kept in sync with self.vertices.
+        # Without use_index, get_vertex searches through every vertex instead
+        # (the reference behaviour, see fuzz.py)
+        self.index = GridIndex()
+        self.use_index = use_index
+
+    def allocate_id(self):
+        if self.compact_ids and self.free_ids:
+            return heapq.heappop(self.free_ids)
+
+        vertex_id = self.next_id
+        self.next_id += 1
+        return vertex_id
+
+    def release_id(self, vertex):
+        if self.compact_ids:
+            self.removed.append(vertex)
+
+    def release_ids(self):
+        """
+        Make the ids of the removed vertices available again. Sanitizing the
+        graph can leave a removed vertex in the edges of a street (it is then
+        still output as part of an edge), so its id is only reused once
+        nothing references the vertex anymore. Otherwise, the edge would be
+        output as an edge to the new vertex with that id
+        """
+        if not self.removed:
+            return
+
+        referenced = set()
+        for segments in self.edges.values():
+            for segment in segments.values():
+                for vertex in segment:
+                    referenced.add(id(vertex))
+
+        still_referenced = []
+        for vertex in self.removed:
+            if id(vertex) in referenced:
+                still_referenced.append(vertex)
+            else:
+                heapq.heappush(self.free_ids, vertex.get_id())
+        self.removed = still_referenced
+
+    def compact(self):
+        """
+        Renumber the vertices so their ids are 0 to n - 1, keeping their
+        relative order. The edges reference the vertex objects directly, so
+        only the vertices need to be updated. Removed vertices that are still
+        referenced by an edge (in either mode, see release_ids) are numbered
+        after them, so they don't share an id with a vertex in the graph
+        """
+        stale = {}
+        for segments in self.edges.values():
+            for segment in segments.values():
+                for vertex in segment:
+                    if not self.has_vertex(vertex):
+                        stale[id(vertex)] = vertex
+        stale = sorted(stale.values(), key=lambda v: v.get_id())
+
+        vertices = sorted(self.vertices.values(), key=lambda v: v.get_id())
+        self.vertices = {}
+        for i, vertex in enumerate(vertices):
+            vertex.set_id(i)
+            self.vertices[i] = vertex
+
+        for i, vertex in enumerate(stale, len(vertices)):
+            vertex.set_id(i)
+
+        # every removed vertex that is not in stale can't be output anymore
+        if self.compact_ids:
+            self.removed = stale
+        self.next_id = len(vertices) + len(stale)
+        self.free_ids = []
+
     def get_vertex(self, coords, is_intersection, is_endpoint):
-        # OPTIMIZE: an Rtree could speed this up?
         # to keep the state consistent, ensure there is only one vertex for
-        # each point in the graph, so search through the existing points to
-        # see if a vertex for this point already exists
-        for vertex in self.vertices.values():
+        # each point in the graph, so search through the existing points near
+        # this one to see if a vertex for this point already exists
+        if self.use_index:
+            nearby = self.index.query_range(
+                coords.x - POS_EPSILON, coords.y - POS_EPSILON,
+                coords.x + POS_EPSILON, coords.y + POS_EPSILON
+            )
+        else:
+            nearby = self.vertices.values()
+
+        for vertex in nearby:
             if vertex.is_equal_to_point(coords):
                 """
                 only update the intersection <endpoint> state of the vertex
@@ -100,8 +196,9 @@ class Graph(object):
                 return vertex
 
         # create the vertex since it does not exist in the graph
-        vertex = Vertex(coords, is_intersection, is_endpoint)
+        vertex = Vertex(self.allocate_id(), coords, is_intersection, is_endpoint)
         self.vertices[vertex.get_id()] = vertex
+        self.index.insert(vertex)
         return vertex
 
     def insert_vertex(self, segment, edges, vertex):
@@ -204,6 +301,11 @@ class Graph(object):
             vertex
         )
 
+    def has_vertex(self, vertex):
+        # compare the objects and not just the ids, in compact mode the id of a
+        # removed vertex can be reused by a new vertex
+        return self.vertices.get(vertex.get_id()) is vertex
+
     def remove_vertex(self, vertex, street_name):
         vertex.remove_street(street_name)
 
@@ -218,31 +320,58 @@ class Graph(object):
 
         # if it is neither an endpoint or intersection, remove it
         if (not vertex.get_is_intersection() and not vertex.get_is_endpoint()
-                and vertex.get_id() in self.vertices):
+                and self.has_vertex(vertex)):
             del self.vertices[vertex.get_id()]
+            self.index.remove(vertex)
+            self.release_id(vertex)
 
     def remove_street(self, street_name):
-        if street_name not in self.edges:
-            return
-
-        # remove this street from all of the vertices on it
-        for segment in self.edges[street_name]:
-            for vertex in self.edges[street_name][segment]:
-                self.remove_vertex(vertex, street_name)
-
-        # remove the street
-        del self.edges[street_name]
+        self.remove_streets([street_name])
 
+    def remove_streets(self, street_names):
+        """
+        Remove several streets from the graph at once. The sanitization of
+        the remaining streets is only done after all of the streets have been
+        removed, instead of once per street. A sanitization sweep can leave
+        the graph in a state that needs another sweep (i.e. removing a segment
+        can remove a vertex that was already kept in another segment), so it
+        is repeated until nothing changes
+        """
+        removed = False
+        for street_name in street_names:
+            if street_name not in self.edges:
+                continue
+
+            # remove this street from all of the vertices on it
+            for segment in self.edges[street_name]:
+                for vertex in self.edges[street_name][segment]:
+                    self.remove_vertex(vertex, street_name)
+
+            # remove the street
+            del self.edges[street_name]
+            removed = True
+
+        if removed:
+            while self.sanitize():
+                pass
+            self.release_ids()
+
+    def sanitize(self):
+        # returns if anything in the graph was changed
+        changed = False
         streets_to_remove = []
         # sanitize the state of the graph, i.e. ensure all of the vertices are
         # in a correct state, remove any that shouldn't be here
         for street in self.edges:
             for segment in self.edges[street]:
                 # remove any references to removed vertices
-                self.edges[street][segment] = list(filter(
-                    lambda v: v.get_id() in self.vertices,
+                vertices = list(filter(
+                    self.has_vertex,
                     self.edges[street][segment]
                 ))
+                if len(vertices) != len(self.edges[street][segment]):
+                    changed = True
+                self.edges[street][segment] = vertices
 
             segment_id_to_remove = []
             # remove any segments in an invalid state, i.e. they need to have at
@@ -270,6 +399,7 @@ class Graph(object):
             # mutating the dict as we are iterating through it
             for segment_id in segment_id_to_remove:
                 del self.edges[street][segment_id]
+                changed = True
 
             # is this street invalid?
             if len(self.edges[street]) == 0:
@@ -280,6 +410,52 @@ class Graph(object):
         for street in streets_to_remove:
             del self.edges[street]
 
+        return changed
+
+    def find_in_range(self, p1, p2):
+        # find all of the vertices in the box with corners p1 and p2, sorted
+        # by id
+        vertices = self.index.query_range(p1.x, p1.y, p2.x, p2.y)
+        return sorted(vertices, key=lambda v: v.get_id())
+
+    def find_nearest(self, p):
+        # find the vertex closest to p, None if the graph is empty
+        return self.index.query_nearest(p.x, p.y)
+
+    def to_arrays(self):
+        """
+        Export the graph as contiguous arrays, a list of the coordinates of
+        each vertex and a list of edges as pairs of indices into it. The
+        indices are dense even if the vertex ids are not, after compact() the
+        index of each vertex is its id. Edges to removed vertices that are
+        still referenced by a street (see release_ids) are left out
+        """
+        vertices = sorted(self.vertices.values(), key=lambda v: v.get_id())
+        index = {}
+        coordinates = []
+        for i, vertex in enumerate(vertices):
+            index[vertex.get_id()] = i
+            coordinates.append((vertex.coordinates.x, vertex.coordinates.y))
+
+        # the same edge can be on more than one street, see __repr__
+        edges = []
+        seen = set()
+        for segments in self.edges.values():
+            for segment in segments.values():
+                for i in range(len(segment) - 1):
+                    if not (self.has_vertex(segment[i])
+                            and self.has_vertex(segment[i + 1])):
+                        continue
+                    id1 = index[segment[i].get_id()]
+                    id2 = index[segment[i + 1].get_id()]
+                    if id1 == id2 or (id1, id2) in seen:
+                        continue
+                    seen.add((id1, id2))
+                    seen.add((id2, id1))
+                    edges.append((id1, id2))
+
+        return coordinates, edges
+
     def __repr__(self):
         # output the vertices
         output = 'V = {\n'
@@ -0,0 +1,136 @@
+from collections import OrderedDict
+
+# estimated sizes in bytes (from memory.deep_sizeof on 64-bit CPython) of the
+# parts of an entry, so that adding an entry doesn't have to walk it
+KEY_SIZE = 136
+KEY_POINT_SIZE = 112
+ENTRY_SIZE = 56
+INTERSECTION_SIZE = 290
+
+
+class IntersectionCache(object):
+    """
+    A bounded LRU cache of the intersections between pairs of streets, keyed by
+    the geometry of both streets. Streets often go back and forth between two
+    geometries (i.e. a change that gets reverted), so this avoids testing every
+    pair of segments again when it happens.
+
+    The intersections are stored by segment index instead of with the segment
+    objects and street names, so the results can be reused for a new Street
+    object with the same geometry.
+
+    The size of the cache is limited in bytes, estimated from the size of the
+    key (the coordinates of both streets) and of the intersections of each
+    entry, since long streets make for much bigger entries
+    """
+    def __init__(self, max_size=4 * 1024 * 1024):
+        # the maximum (estimated) number of bytes to use, 0 disables the cache
+        self.max_size = max_size
+        # key -> (intersections, estimated size)
+        self.entries = OrderedDict()
+        self.size = 0
+
+        # statistics about how the cache is being used
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def find_intersections(self, street1, street2):
+        # street1 is always the first street in the results, so the order of
+        # the key matters, but a pair stored in the other order can be reused
+        # by swapping the segments
+        key = (street1.get_key(), street2.get_key())
+        reversed_key = (key[1], key[0])
+
+        if key in self.entries:
+            self.hits += 1
+            # mark the entry as the most recently used one
+            entry = self.entries.pop(key)
+            self.entries[key] = entry
+            return self.build_intersections(street1, street2, entry[0])
+        elif reversed_key in self.entries:
+            self.hits += 1
+            entry = self.entries.pop(reversed_key)
+            self.entries[reversed_key] = entry
+            # keep the same order as Street.find_intersections, which goes
+            # through the segments of street1 first
+            return self.build_intersections(street1, street2, sorted(
+                [(idx1, idx2, coords) for idx2, idx1, coords in entry[0]],
+                key=lambda e: (e[0], e[1])
+            ))
+
+        self.misses += 1
+        intersections = street1.find_intersections(street2)
+
+        if self.max_size > 0:
+            self.add(key, [
+                (
+                    intersection.get('segment1').get_index(),
+                    intersection.get('segment2').get_index(),
+                    intersection.get('coords')
+                )
+                for intersection in intersections
+            ])
+
+        return intersections
+
+    def add(self, key, entry):
+        # the key and entry share objects with the streets and the graph, but
+        # they are kept alive by the cache, so they are counted as its own
+        size = (
+            KEY_SIZE + KEY_POINT_SIZE * (len(key[0]) + len(key[1]))
+            + ENTRY_SIZE + INTERSECTION_SIZE * len(entry)
+        )
+
+        # an entry that does not fit in the cache on its own is not stored
+        if size > self.max_size:
+            return
+
+        self.entries[key] = (entry, size)
+        self.size += size
+
+        # evict the least recently used entries
+        while self.size > self.max_size:
+            evicted_key, (evicted, evicted_size) = self.entries.popitem(last=False)
+            self.size -= evicted_size
+            self.evictions += 1
+
+    def build_intersections(self, street1, street2, entry):
+        # rebuild the intersections for the given streets from the cache entry
+        segments1 = street1.get_segments()
+        segments2 = street2.get_segments()
+        return [
+            {
+                'street1': street1.name,
+                'segment1': segments1[idx1],
+                'street2': street2.name,
+                'segment2': segments2[idx2],
+                'coords': coords
+            }
+            for idx1, idx2, coords in entry
+        ]
+
+    def clear(self):
+        self.entries.clear()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get_stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'pairs': len(self.entries),
+            'size': self.size,
+            'max_size': self.max_size
+        }
+
+    def report(self):
+        stats = self.get_stats()
+        return (
+            'Intersection cache: %(hits)d hit(s), %(misses)d miss(es), '
+            '%(evictions)d eviction(s), %(pairs)d pair(s) cached in '
+            '%(size)d of %(max_size)d bytes' % stats
+        )
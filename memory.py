@@ -0,0 +1,177 @@
+from __future__ import print_function
+
+import sys
+
+# tracemalloc is not available on python 2, the accounting is disabled there
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+
+def deep_sizeof(obj, seen):
+    """
+    Estimate the memory used by obj and everything it references. Objects in
+    seen are not counted again, so sharing seen between calls counts objects
+    that are referenced from more than one place only once
+    """
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        for key, value in obj.items():
+            size += deep_sizeof(key, seen) + deep_sizeof(value, seen)
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        for item in obj:
+            size += deep_sizeof(item, seen)
+    elif hasattr(obj, '__dict__'):
+        size += deep_sizeof(obj.__dict__, seen)
+
+    return size
+
+
+def get_size_breakdown(streets, graph, intersection_cache=None):
+    # the vertices are referenced by the edges and the points are shared
+    # between the streets and the vertices, each object is counted towards
+    # the first structure it is found in
+    seen = set()
+    breakdown = [
+        ('streets', deep_sizeof(streets, seen)),
+        ('vertices', deep_sizeof(graph.vertices, seen)),
+        ('edges', deep_sizeof(graph.edges, seen))
+    ]
+
+    # the cache keeps track of its own (estimated) size
+    if intersection_cache is not None:
+        breakdown.append(('intersection cache', intersection_cache.size))
+    return breakdown
+
+
+def get_element_count(streets, graph):
+    # a cheap measure of how big the street database and graph are, the
+    # streets and their edges are counted by segment and vertex, since a long
+    # street uses much more memory than a short one
+    return (
+        sum(len(street.get_segments()) for street in streets.values())
+        + len(graph.vertices)
+        + sum(
+            len(segment)
+            for segments in graph.edges.values()
+            for segment in segments.values()
+        )
+    )
+
+
+# how much the street database and graph can grow or shrink (as a factor of
+# the number of elements) before their size is measured again
+RESIZE_FACTOR = 2
+
+
+class MemoryAccounting(object):
+    """
+    Tracks the memory allocated and retained by each type of command with
+    tracemalloc, and optionally enforces a budget on the size of the street
+    database and graph. With refuse set, new streets are not added once the
+    budget is exceeded, otherwise a warning is printed
+    """
+    def __init__(self, track=True, budget=None, refuse=False):
+        self.track = track and tracemalloc is not None
+        self.budget = budget
+        self.refuse = refuse
+
+        # action -> [number of commands, bytes allocated, bytes retained]
+        self.usage = {}
+
+        # the last measured size of the street database and graph, and the
+        # number of elements they had then, see get_size
+        self.measured_size = None
+        self.measured_count = 0
+
+        if self.track and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def measure(self, action, func, *args):
+        if not self.track:
+            return func(*args)
+
+        # the peak is only reset on python 3.9+, before that it is the peak
+        # since tracing started
+        if hasattr(tracemalloc, 'reset_peak'):
+            tracemalloc.reset_peak()
+        before = tracemalloc.get_traced_memory()[0]
+
+        try:
+            return func(*args)
+        finally:
+            current, peak = tracemalloc.get_traced_memory()
+            if action not in self.usage:
+                self.usage[action] = [0, 0, 0]
+            self.usage[action][0] += 1
+            self.usage[action][1] += max(peak - before, 0)
+            self.usage[action][2] += current - before
+
+    def measure_size(self, streets, graph):
+        self.measured_size = sum(
+            size for name, size in get_size_breakdown(streets, graph)
+        )
+        self.measured_count = get_element_count(streets, graph)
+        return self.measured_size
+
+    def get_size(self, streets, graph):
+        """
+        Estimate the size of the street database and graph. Measuring it goes
+        through every object, so it is only measured again once the number of
+        elements grows or shrinks by RESIZE_FACTOR, in between the last
+        measurement is scaled by the number of elements. This keeps the cost
+        of checking the budget constant (amortized) per command
+        """
+        count = get_element_count(streets, graph)
+        if (self.measured_size is None
+                or count > self.measured_count * RESIZE_FACTOR
+                or count * RESIZE_FACTOR < self.measured_count):
+            return self.measure_size(streets, graph)
+
+        if self.measured_count == 0:
+            return self.measured_size
+        return self.measured_size * count // self.measured_count
+
+    def is_over_budget(self, streets, graph, intersection_cache=None):
+        # check if the street database, graph and intersection cache use more
+        # memory than allowed, prints a warning if they do
+        if self.budget is None:
+            return False
+
+        cache_size = intersection_cache.size if intersection_cache else 0
+        size = self.get_size(streets, graph) + cache_size
+        # confirm an estimate that just went over the budget before acting on
+        # it, once the measured size is over the budget the estimate is used
+        if size > self.budget and self.measured_size + cache_size <= self.budget:
+            size = self.measure_size(streets, graph) + cache_size
+
+        if size <= self.budget:
+            return False
+
+        print(
+            'Warning: the street database and graph use %d bytes, over the '
+            'budget of %d bytes' % (size, self.budget),
+            file=sys.stderr
+        )
+        return True
+
+    def report(self, streets, graph, intersection_cache=None):
+        output = ''
+        if self.track:
+            output += 'Memory usage by command:\n'
+            for action in sorted(self.usage):
+                count, allocated, retained = self.usage[action]
+                output += '  %s: %d command(s), %d bytes allocated, %d bytes retained\n' % (
+                    action, count, allocated, retained
+                )
+
+        output += 'Memory usage of the street database and graph:\n'
+        for name, size in get_size_breakdown(streets, graph, intersection_cache):
+            output += '  %s: %d bytes\n' % (name, size)
+
+        print(output, end='', file=sys.stderr)
@@ -11,14 +11,17 @@ def throw_error(msg):
 
 """
 Action and street name regex - matches the action and street name
-    ([acrg]) - check for a valid action: a, c, r or g
+    ([acrgbeqn]) - check for a valid action: a, c, r, g, b (begin a batch),
+                   e (end a batch), q (vertices in a range) or n (nearest
+                   vertex)
     (?:
         \s+ - check for one or more spaces after the action
         "([\w\s]+)" - check for word characters or spaces between double quotes
-    )? - the street name is optional, not required for `g`
+    )? - the street name is optional, not required for `g`, `b`, `e`, `q` or
+         `n`
     \s* - check for white space after the street name or command
 """
-r_input = re.compile(r'([acrg])(?:\s+"([\w\s]+)")?\s*')
+r_input = re.compile(r'([acrgbeqn])(?:\s+"([\w\s]+)")?\s*')
 
 """
 Coordinate regex - matches one set of coordinates followed by optional
@@ -43,6 +46,19 @@ Ensure there is a space between the street name and coordinate list
 """
 r_valid_input = re.compile(r'(\"\s+\()')
 
+"""
+Street name regex - a street name on its own, i.e. from a map file
+    [\w ]+ - word characters or spaces, a newline or tab could not be given
+             as part of a command
+    \Z - nothing else after the street name (unlike $, not even a newline)
+"""
+r_street_name = re.compile(r'[\w ]+\Z')
+
+
+def is_valid_street_name(street_name):
+    # check that the street name could be given in a command
+    return bool(r_street_name.match(street_name))
+
 
 def parse(line):
     # parse the action and street name
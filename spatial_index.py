@@ -0,0 +1,142 @@
+import math
+
+
+class GridIndex(object):
+    """
+    A uniform grid over the vertices of the graph, used to find the vertices
+    close to a point without looking at every vertex. Each cell holds the
+    vertices whose coordinates fall in it
+    """
+    def __init__(self, cell_size=4.0):
+        self.cell_size = float(cell_size)
+        self.cells = {}
+
+    def get_cell(self, x, y):
+        return (
+            int(math.floor(x / self.cell_size)),
+            int(math.floor(y / self.cell_size))
+        )
+
+    def insert(self, vertex):
+        cell = self.get_cell(vertex.coordinates.x, vertex.coordinates.y)
+        if cell not in self.cells:
+            self.cells[cell] = []
+        self.cells[cell].append(vertex)
+
+    def remove(self, vertex):
+        cell = self.get_cell(vertex.coordinates.x, vertex.coordinates.y)
+        if cell not in self.cells or vertex not in self.cells[cell]:
+            return
+
+        self.cells[cell].remove(vertex)
+        # drop empty cells so they are not visited by the queries
+        if not self.cells[cell]:
+            del self.cells[cell]
+
+    def clear(self):
+        self.cells = {}
+
+    def cells_in_range(self, x1, y1, x2, y2):
+        # get the (non-empty) cells that overlap the given box
+        cx1, cy1 = self.get_cell(x1, y1)
+        cx2, cy2 = self.get_cell(x2, y2)
+
+        # if the box covers more cells than there are non-empty cells, it is
+        # faster to go through the non-empty cells
+        if (cx2 - cx1 + 1) * (cy2 - cy1 + 1) > len(self.cells):
+            return [
+                cell for (cx, cy), cell in self.cells.items()
+                if cx1 <= cx <= cx2 and cy1 <= cy <= cy2
+            ]
+
+        cells = []
+        for cx in range(cx1, cx2 + 1):
+            for cy in range(cy1, cy2 + 1):
+                if (cx, cy) in self.cells:
+                    cells.append(self.cells[(cx, cy)])
+        return cells
+
+    def query_range(self, x1, y1, x2, y2):
+        # find all of the vertices in the box, inclusive, the corners can be
+        # given in any order
+        x1, x2 = min(x1, x2), max(x1, x2)
+        y1, y2 = min(y1, y2), max(y1, y2)
+
+        vertices = []
+        for cell in self.cells_in_range(x1, y1, x2, y2):
+            for vertex in cell:
+                if (x1 <= vertex.coordinates.x <= x2
+                        and y1 <= vertex.coordinates.y <= y2):
+                    vertices.append(vertex)
+        return vertices
+
+    def query_nearest(self, x, y):
+        """
+        Find the vertex closest to (x, y), ties are broken by the lowest x and
+        then y coordinate, so the result does not depend on how the vertices
+        are numbered.
+        The cells are searched in rings around the cell containing (x, y),
+        once the closest vertex found is closer than anything in the next ring
+        could be, the search can stop.
+
+        Once a ring has more cells than there are non-empty cells (i.e. the
+        point is far away from the vertices), the remaining non-empty cells are
+        searched directly instead, the same trick as in cells_in_range
+        """
+        if not self.cells:
+            return None
+
+        cx, cy = self.get_cell(x, y)
+
+        best = None
+        best_distance = None
+        ring = 0
+        while True:
+            # any vertex in this ring, or beyond it, is at least this far away
+            if best is not None and (ring - 1) * self.cell_size > math.sqrt(best_distance[0]):
+                break
+
+            last = 8 * ring > len(self.cells)
+            if last:
+                # all of the cells closer than this ring have been searched
+                cells = [
+                    cell for (cell_x, cell_y), cell in self.cells.items()
+                    if max(abs(cell_x - cx), abs(cell_y - cy)) >= ring
+                ]
+            else:
+                cells = [
+                    self.cells[cell] for cell in self.get_ring(cx, cy, ring)
+                    if cell in self.cells
+                ]
+
+            for cell in cells:
+                for vertex in cell:
+                    distance = (
+                        (vertex.coordinates.x - x) ** 2
+                        + (vertex.coordinates.y - y) ** 2,
+                        vertex.coordinates.x,
+                        vertex.coordinates.y
+                    )
+                    if best is None or distance < best_distance:
+                        best = vertex
+                        best_distance = distance
+
+            if last:
+                break
+            ring += 1
+
+        return best
+
+    def get_ring(self, cx, cy, ring):
+        # the cells that are exactly `ring` cells away from (cx, cy)
+        if ring == 0:
+            return [(cx, cy)]
+
+        cells = []
+        for i in range(-ring, ring + 1):
+            cells.append((cx + i, cy - ring))
+            cells.append((cx + i, cy + ring))
+        for i in range(-ring + 1, ring):
+            cells.append((cx - ring, cy + i))
+            cells.append((cx + ring, cy + i))
+        return cells
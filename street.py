@@ -192,6 +192,10 @@ class Street(object):
         self.segments = []
         self.add_segments(coordinates)
 
+        # the geometry of the street as a hashable tuple, used to look up
+        # previously calculated intersections
+        self.key = tuple((p.x, p.y) for p in coordinates)
+
     def add_segments(self, coordinates):
         # add all of the segments to this street
         for i in range(len(coordinates) - 1):
@@ -200,6 +204,9 @@ class Street(object):
     def get_segments(self):
         return self.segments
 
+    def get_key(self):
+        return self.key
+
     def find_intersections(self, street):
         # find all of the intersections between this street and the given street
         intersections = []
@@ -1,10 +1,20 @@
 ## A simple unit test example. Replace by your own tests
 
+import os
 import re
 import sys
+import tempfile
 import unittest
 
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+
 import a1ece650 as a1
+from graph import Graph
+from intersection_cache import IntersectionCache
+from memory import MemoryAccounting, get_size_breakdown, tracemalloc
 
 class MyTest(unittest.TestCase):
 
@@ -47,5 +57,524 @@ class MyTest(unittest.TestCase):
         """A test that fails"""
         self.assertEqual(True, False)
 
+class CommandTest(unittest.TestCase):
+    """Runs commands against a fresh street database and graph"""
+
+    def setUp(self):
+        a1.streets = {}
+        a1.graph = Graph()
+        a1.intersection_cache = IntersectionCache(a1.INTERSECTION_CACHE_SIZE)
+        a1.batch = None
+
+    def run_commands(self, *lines):
+        """Run the commands, returning what was printed to stdout and stderr"""
+        stdout, stderr = sys.stdout, sys.stderr
+        sys.stdout, sys.stderr = StringIO(), StringIO()
+        try:
+            for line in lines:
+                a1.execute_command(a1.parse(line))
+            return sys.stdout.getvalue(), sys.stderr.getvalue()
+        finally:
+            sys.stdout, sys.stderr = stdout, stderr
+
+
+class BatchTest(CommandTest):
+
+    def test_batch_applied_on_end(self):
+        """Test that the commands in a batch are only applied at the end"""
+        self.run_commands('b', 'a "Weber" (0,0) (2,2)', 'a "King" (0,2) (2,0)')
+        self.assertEqual(a1.streets, {})
+        self.assertEqual(a1.graph.vertices, {})
+
+        out, err = self.run_commands('e')
+        self.assertEqual(err, '')
+        self.assertEqual(sorted(a1.streets), ['king', 'weber'])
+        self.assertEqual(len(a1.graph.vertices), 5)
+
+    def test_batch_rollback(self):
+        """Test that an invalid command rolls back the whole batch"""
+        self.run_commands('a "Weber" (0,0) (2,2)')
+        before = str(a1.graph)
+
+        out, err = self.run_commands(
+            'b', 'a "King" (0,2) (2,0)', 'r "Weber"', 'r "Nope"', 'e'
+        )
+        self.assertIn('rolled back', err)
+        self.assertEqual(sorted(a1.streets), ['weber'])
+        self.assertEqual(str(a1.graph), before)
+        self.assertIsNone(a1.batch)
+
+    def assertSameAsCommands(self, *lines):
+        """Check that a batch gives the same graph as running the commands"""
+        self.setUp()
+        out, err = self.run_commands(*(('b',) + lines + ('e', 'g')))
+        self.assertEqual(err, '')
+        batch_vertices = sorted(str(v.coordinates) for v in a1.graph.vertices.values())
+        batch_edges = sorted(out.split('E =')[1].replace(',\n', '\n').split('\n'))
+
+        self.setUp()
+        out, err = self.run_commands(*(lines + ('g',)))
+        self.assertEqual(
+            sorted(str(v.coordinates) for v in a1.graph.vertices.values()),
+            batch_vertices
+        )
+        self.assertEqual(
+            sorted(out.split('E =')[1].replace(',\n', '\n').split('\n')),
+            batch_edges
+        )
+
+    def test_batch_add_and_remove(self):
+        """Test a street added and removed in a batch"""
+        self.assertSameAsCommands(
+            'a "Weber" (0,0) (2,2)',
+            'a "King" (0,2) (2,0)',
+            'r "King"'
+        )
+        self.assertEqual(sorted(a1.streets), ['weber'])
+        self.assertEqual(a1.graph.vertices, {})
+
+    def test_batch_same_as_commands(self):
+        """Test that a batch gives the same graph as running its commands"""
+        self.assertSameAsCommands(
+            'a "a" (2,1) (4,6) (5,5)',
+            'a "b" (0,3) (1,6) (8,5)',
+            'a "c" (4,6) (5,5) (7,5)',
+            'a "d" (0,6) (1,6) (2,1)',
+            'r "b"',
+            'c "a" (4,0) (6,4)'
+        )
+        self.assertSameAsCommands(
+            'a "c" (1,3) (3,5) (8,2)',
+            'a "b" (2,5) (3,5) (5,3)',
+            'a "a" (2,4) (7,2)',
+            'a "d" (3,6) (5,3) (6,3)',
+            'r "b"'
+        )
+
+    def test_batch_after_commands(self):
+        """Test a batch that removes streets after they were added"""
+        self.run_commands(
+            'a "a" (2,1) (4,6) (5,5)',
+            'a "b" (0,3) (1,6) (8,5)',
+            'a "c" (4,6) (5,5) (7,5)',
+            'a "d" (0,6) (1,6) (2,1)'
+        )
+        out, err = self.run_commands('b', 'r "b"', 'c "a" (4,0) (6,4)', 'e', 'g')
+        self.assertEqual(out, 'V = {\n}\nE = {\n}\n')
+
+    def test_nested_batch(self):
+        """Test that a batch can not be started inside another batch"""
+        out, err = self.run_commands('b', 'a "Weber" (0,0) (2,2)', 'b')
+        self.assertIn('already in progress', err)
+
+        # the open batch is kept
+        out, err = self.run_commands('e')
+        self.assertEqual(err, '')
+        self.assertEqual(sorted(a1.streets), ['weber'])
+
+    def test_end_without_begin(self):
+        """Test that ending a batch that was never started is an error"""
+        out, err = self.run_commands('e')
+        self.assertIn('never started', err)
+
+    def test_graph_inside_batch(self):
+        """Test that the graph can not be output inside a batch"""
+        out, err = self.run_commands('b', 'g')
+        self.assertEqual(out, '')
+        self.assertIn('batch is in progress', err)
+        self.assertEqual(a1.batch, [])
+
+
+class IntersectionCacheTest(CommandTest):
+
+    def test_cache_hit_on_revert(self):
+        """Test that reverting a change reuses the cached intersections"""
+        commands = [
+            'a "Weber" (0,0) (4,4)',
+            'a "King" (0,4) (4,0)',
+            'a "Davenport" (0,1) (4,1)',
+            'c "King" (0,3) (3,0)',
+            'c "King" (0,4) (4,0)',
+            'g'
+        ]
+        out, err = self.run_commands(*commands)
+
+        # King is added back after Davenport, so its pair with Davenport is
+        # found in the reverse order
+        stats = a1.intersection_cache.get_stats()
+        self.assertEqual((stats['hits'], stats['misses']), (2, 5))
+
+        # the cached intersections give the same graph as computing them
+        self.setUp()
+        a1.intersection_cache = IntersectionCache(0)
+        self.assertEqual(self.run_commands(*commands), (out, err))
+
+    def test_reversed_hit(self):
+        """Test that a pair cached in one order is reused in the other"""
+        weber = a1.Street('weber', [a1.Point(0, 0), a1.Point(4, 4), a1.Point(8, 0)])
+        king = a1.Street('king', [a1.Point(0, 2), a1.Point(8, 2)])
+        cache = IntersectionCache()
+
+        cache.find_intersections(weber, king)
+        result = cache.find_intersections(king, weber)
+        expected = king.find_intersections(weber)
+        self.assertEqual(cache.get_stats()['hits'], 1)
+
+        self.assertEqual(len(result), len(expected))
+        for r, e in zip(result, expected):
+            self.assertEqual(r['street1'], 'king')
+            self.assertIs(r['segment1'], e['segment1'])
+            self.assertIs(r['segment2'], e['segment2'])
+            self.assertTrue(r['coords'].is_equal_to_point(e['coords']))
+
+    def test_eviction(self):
+        """Test that the least recently used pair is evicted"""
+        streets = [
+            a1.Street('s%d' % i, [a1.Point(i, 0), a1.Point(i, 5)])
+            for i in range(3)
+        ]
+        cross = a1.Street('cross', [a1.Point(-1, 1), a1.Point(5, 2)])
+
+        # the entries are all the same size, make room for two of them
+        cache = IntersectionCache()
+        cache.find_intersections(streets[0], cross)
+        cache.max_size = cache.size * 2
+
+        cache.find_intersections(streets[1], cross)
+        # use s0 so s1 is the least recently used
+        cache.find_intersections(streets[0], cross)
+        cache.find_intersections(streets[2], cross)
+        self.assertEqual(cache.evictions, 1)
+        self.assertLessEqual(cache.size, cache.max_size)
+
+        cache.find_intersections(streets[0], cross)
+        self.assertEqual((cache.hits, cache.misses), (2, 3))
+        cache.find_intersections(streets[1], cross)
+        self.assertEqual((cache.hits, cache.misses), (2, 4))
+
+        cache.clear()
+        self.assertEqual(cache.get_stats()['pairs'], 0)
+        self.assertEqual(cache.size, 0)
+        self.assertEqual((cache.hits, cache.misses, cache.evictions), (0, 0, 0))
+
+    def test_size_limit(self):
+        """Test that the cache is limited by the size of its entries"""
+        def street(name, y):
+            # a long street crossing all of the vertical streets
+            return a1.Street(name, [a1.Point(x, y + x % 2) for x in range(100)])
+
+        cache = IntersectionCache(50000)
+        for i in range(16):
+            cache.find_intersections(street('a%d' % i, i), street('b%d' % i, -i))
+            self.assertLessEqual(cache.size, cache.max_size)
+        self.assertGreater(cache.evictions, 0)
+
+        # an entry bigger than the cache is not stored
+        cache = IntersectionCache(100)
+        cache.find_intersections(street('a', 0), street('b', 1))
+        self.assertEqual(cache.get_stats()['pairs'], 0)
+
+    def test_disabled(self):
+        """Test that a cache with a size of 0 stores nothing"""
+        a1.intersection_cache = IntersectionCache(0)
+        self.run_commands('a "Weber" (0,0) (4,4)', 'a "King" (0,4) (4,0)')
+        self.assertEqual(a1.intersection_cache.get_stats()['size'], 0)
+        self.assertEqual(len(a1.graph.vertices), 5)
+
+
+class VertexIdTest(CommandTest):
+
+    def test_ids_per_graph(self):
+        """Test that each graph allocates its own ids"""
+        self.run_commands('a "Weber" (0,0) (4,4)', 'a "King" (0,4) (4,0)')
+        self.assertEqual(sorted(a1.graph.vertices), [0, 1, 2, 3, 4])
+
+        self.setUp()
+        self.run_commands('a "Weber" (0,0) (4,4)', 'a "King" (0,4) (4,0)')
+        self.assertEqual(sorted(a1.graph.vertices), [0, 1, 2, 3, 4])
+
+    def test_free_list_reuse(self):
+        """Test that the ids of removed vertices are reused in compact mode"""
+        a1.graph = Graph(compact_ids=True)
+        self.run_commands(
+            'a "Weber" (0,0) (4,4)',
+            'a "King" (0,4) (4,0)',
+            'r "King"'
+        )
+        self.assertEqual(a1.graph.vertices, {})
+        self.assertEqual(sorted(a1.graph.free_ids), [0, 1, 2, 3, 4])
+
+        self.run_commands('a "King" (0,3) (3,0)')
+        self.assertEqual(sorted(a1.graph.vertices), [0, 1, 2, 3, 4])
+        self.assertEqual(a1.graph.next_id, 5)
+
+    def test_ids_not_reused(self):
+        """Test that the ids only grow without compact mode"""
+        self.run_commands(
+            'a "Weber" (0,0) (4,4)',
+            'a "King" (0,4) (4,0)',
+            'r "King"',
+            'a "King" (0,3) (3,0)'
+        )
+        self.assertEqual(sorted(a1.graph.vertices), [5, 6, 7, 8, 9])
+
+    def test_compact(self):
+        """Test that compact renumbers the vertices densely"""
+        self.run_commands(
+            'a "Weber" (0,0) (4,4)',
+            'a "King" (0,4) (4,0)',
+            'a "Davenport" (0,1) (4,1)',
+            'r "King"'
+        )
+        ids = sorted(a1.graph.vertices)
+        self.assertNotEqual(ids, list(range(len(ids))))
+        coordinates, edges = a1.graph.to_arrays()
+
+        a1.graph.compact()
+        self.assertEqual(sorted(a1.graph.vertices), list(range(len(ids))))
+        for vertex_id, vertex in a1.graph.vertices.items():
+            self.assertEqual(vertex.get_id(), vertex_id)
+
+        # the relative order is kept, so the arrays are the same and the
+        # index of each vertex is now its id
+        self.assertEqual(a1.graph.to_arrays(), (coordinates, edges))
+        for vertex_id, vertex in a1.graph.vertices.items():
+            self.assertEqual(
+                coordinates[vertex_id],
+                (vertex.coordinates.x, vertex.coordinates.y)
+            )
+
+        # new vertices continue after the compacted ids
+        self.run_commands('a "King" (0,4) (4,0)')
+        self.assertEqual(max(a1.graph.vertices), len(a1.graph.vertices) - 1)
+
+    def make_stale_vertex(self):
+        """
+        Build a graph where a removed vertex is still referenced by an edge,
+        which sanitizing the graph can leave behind (see Graph.release_ids)
+        """
+        self.run_commands(
+            'a "a" (0,4) (2,3) (6,3)',
+            'a "b" (4,1) (5,4) (7,1)',
+            'a "c" (1,6) (2,2) (4,4)',
+            'a "d" (1,5) (4,0)',
+            'r "c"'
+        )
+        stale = a1.graph.edges['d'][0][0]
+        del a1.graph.vertices[stale.get_id()]
+        a1.graph.index.remove(stale)
+        return stale
+
+    def test_compact_stale_vertex(self):
+        """Test that compact gives a removed vertex an unused id"""
+        stale = self.make_stale_vertex()
+        a1.graph.compact()
+
+        self.assertEqual(sorted(a1.graph.vertices), list(range(len(a1.graph.vertices))))
+        self.assertEqual(stale.get_id(), len(a1.graph.vertices))
+        self.assertFalse(a1.graph.has_vertex(stale))
+        self.assertEqual(a1.graph.next_id, len(a1.graph.vertices) + 1)
+
+    def test_to_arrays_stale_vertex(self):
+        """Test that to_arrays leaves out the edges to a removed vertex"""
+        self.make_stale_vertex()
+        coordinates, edges = a1.graph.to_arrays()
+
+        self.assertEqual(len(coordinates), len(a1.graph.vertices))
+        self.assertEqual(len(edges), 8)
+        for id1, id2 in edges:
+            self.assertLess(max(id1, id2), len(coordinates))
+
+    def test_has_vertex_after_reuse(self):
+        """Test that a removed vertex is not alive when its id is reused"""
+        a1.graph = Graph(compact_ids=True)
+        self.run_commands('a "Weber" (0,0) (4,4)', 'a "King" (0,4) (4,0)')
+        removed = list(a1.graph.vertices.values())
+
+        self.run_commands('r "King"', 'a "King" (0,3) (3,0)')
+        for vertex in removed:
+            self.assertIn(vertex.get_id(), a1.graph.vertices)
+            self.assertFalse(a1.graph.has_vertex(vertex))
+
+        for vertex in a1.graph.vertices.values():
+            self.assertTrue(a1.graph.has_vertex(vertex))
+
+
+class LoadMapTest(CommandTest):
+
+    def load_map(self, *lines):
+        """Load a map file with the given lines, returning stderr"""
+        fd, path = tempfile.mkstemp()
+        try:
+            with os.fdopen(fd, 'w') as map_file:
+                map_file.write('\n'.join(lines))
+
+            stderr = sys.stderr
+            sys.stderr = StringIO()
+            try:
+                a1.load_map(path)
+                return sys.stderr.getvalue()
+            finally:
+                sys.stderr = stderr
+        finally:
+            os.remove(path)
+
+    def test_load_map(self):
+        """Test that loading a map gives the same graph as adding the streets"""
+        err = self.load_map(
+            '{"name": "Weber", "coordinates": [[0, 0], [4, 4]]}',
+            '',
+            '{"name": "King", "coordinates": [[0, 4], [4, 0]]}'
+        )
+        self.assertEqual(err, '')
+        graph = str(a1.graph)
+
+        # the initial load does not go through the intersection cache
+        self.assertEqual(a1.intersection_cache.get_stats()['misses'], 0)
+
+        self.setUp()
+        self.run_commands('a "Weber" (0,0) (4,4)', 'a "King" (0,4) (4,0)')
+        self.assertEqual(str(a1.graph), graph)
+
+    def test_load_map_invalid(self):
+        """Test that the invalid lines of a map are skipped"""
+        err = self.load_map(
+            'not json',
+            '{"name": "q\\"uote", "coordinates": [[0, 0], [1, 1]]}',
+            '{"name": "half", "coordinates": [[1.5, 2], [1, 1]]}',
+            '{"name": "one", "coordinates": [[1, 1]]}',
+            '{"name": "Weber", "coordinates": [[0, 0], [4, 4]]}',
+            '{"name": "weber", "coordinates": [[0, 4], [4, 0]]}',
+            '{"name": "d\\n", "coordinates": [[0, 0], [1, 1]]}',
+            '{"name": "d\\te", "coordinates": [[0, 0], [1, 1]]}'
+        )
+        self.assertIn('line 1 ', err)
+        self.assertIn('letters, numbers, underscores and spaces. (line 2 ', err)
+        self.assertIn('must be integers. (line 3 ', err)
+        self.assertIn('2 or more points. (line 4 ', err)
+        self.assertIn('already exists. (line 6 ', err)
+        self.assertIn('letters, numbers, underscores and spaces. (line 7 ', err)
+        self.assertIn('letters, numbers, underscores and spaces. (line 8 ', err)
+        self.assertEqual(list(a1.streets), ['weber'])
+
+
+class SpatialQueryTest(CommandTest):
+
+    def setUp(self):
+        CommandTest.setUp(self)
+        self.run_commands(
+            'a "Weber Street" (2,-1) (2,2) (5,5) (5,6) (3,8)',
+            'a "King Street S" (4,2) (4,8)',
+            'a "Davenport Road" (1,4) (5,8)'
+        )
+
+    def test_range(self):
+        """Test that a range query returns the vertices in the box"""
+        out, err = self.run_commands('q (0,0) (4,4)', 'q (10,10) (20,20)')
+        self.assertEqual(err, '')
+        self.assertEqual(out, (
+            'V = {\n  0: (4.00, 4.00)\n  1: (2.00, 2.00)\n'
+            '  3: (4.00, 2.00)\n  8: (1.00, 4.00)\n}\n'
+            'V = {\n}\n'
+        ))
+
+    def test_nearest(self):
+        """Test that the nearest vertex is found, near and far from the graph"""
+        for line in ['n (2,3)', 'n (40000,40000)', 'n (-2000000,-2000000)']:
+            out, err = self.run_commands(line)
+            p = a1.parse(line)['coordinates'][0]
+            expected = min(
+                a1.graph.vertices.values(),
+                key=lambda v: ((v.coordinates.x - p.x) ** 2
+                               + (v.coordinates.y - p.y) ** 2,
+                               v.coordinates.x, v.coordinates.y)
+            )
+            self.assertEqual(out, 'V = {\n  %s\n}\n' % expected)
+
+    def test_index_in_sync(self):
+        """Test that the index follows the vertices as streets are removed"""
+        self.run_commands('r "King Street S"', 'r "Davenport Road"')
+        out, err = self.run_commands('q (-100,-100) (100,100)', 'n (0,0)')
+        self.assertEqual(out, 'V = {\n}\nV = {\n}\n')
+        self.assertEqual(a1.graph.index.cells, {})
+
+
+class MemoryBudgetTest(CommandTest):
+
+    def tearDown(self):
+        a1.memory = None
+        # MemoryAccounting starts tracing when tracking is enabled
+        if tracemalloc is not None:
+            tracemalloc.stop()
+
+    def test_refuse_over_budget(self):
+        """Test that streets are refused once the budget is exceeded"""
+        a1.memory = MemoryAccounting(track=False, budget=10, refuse=True)
+        out, err = self.run_commands(
+            'a "Weber" (0,0) (4,4)',
+            'b', 'a "King" (0,4) (4,0)', 'e',
+            'b', 'r "Weber"', 'e'
+        )
+        self.assertIn('the street was not added', err)
+        self.assertIn('the batch was rolled back', err)
+        self.assertIsNone(a1.batch)
+        self.assertEqual(a1.streets, {})
+
+    def test_warn_over_budget(self):
+        """Test that streets are still added with only a warning"""
+        a1.memory = MemoryAccounting(track=False, budget=10)
+        out, err = self.run_commands('a "Weber" (0,0) (4,4)')
+        self.assertIn('Warning:', err)
+        self.assertEqual(list(a1.streets), ['weber'])
+
+    def test_long_streets_over_budget(self):
+        """Test that long streets count for more than short ones"""
+        a1.memory = MemoryAccounting(track=False, budget=300000, refuse=True)
+        # only the estimate of the streets and graph is tested
+        a1.intersection_cache = IntersectionCache(0)
+        self.run_commands(*[
+            'a "s%d" (%d,0) (%d,5)' % (i, i * 10, i * 10 + 1) for i in range(8)
+        ])
+        out, err = self.run_commands(*[
+            'a "l%d" %s' % (i, ' '.join(
+                '(%d,%d)' % (x, 100 + i * 10 + x % 2) for x in range(500)
+            ))
+            for i in range(8)
+        ])
+        self.assertIn('the street was not added', err)
+
+        # the last street added before the budget was exceeded can go over it
+        size = sum(size for name, size in get_size_breakdown(a1.streets, a1.graph))
+        self.assertLess(size, 2 * a1.memory.budget)
+
+    def test_size_measured_rarely(self):
+        """Test that the size is not measured again for every command"""
+        a1.memory = MemoryAccounting(track=False, budget=10 ** 9)
+        sizes = []
+        measure_size = a1.memory.measure_size
+        a1.memory.measure_size = lambda *args: sizes.append(1) or measure_size(*args)
+
+        self.run_commands(*[
+            'a "s%d" (%d,0) (%d,5)' % (i, i, i + 1) for i in range(64)
+        ])
+        self.assertEqual(len(a1.streets), 64)
+        self.assertLess(len(sizes), 10)
+
+    def test_budget_not_measured_in_command(self):
+        """Test that checking the budget is not counted as part of `a`"""
+        a1.memory = MemoryAccounting(budget=10 ** 9)
+        if not a1.memory.track:
+            self.skipTest('tracemalloc is not available')
+
+        calls = []
+        measure = a1.memory.measure
+        a1.memory.measure = lambda *args: calls.append(a1.memory.measured_size) or measure(*args)
+        self.run_commands('a "Weber" (0,0) (4,4)')
+
+        # the size was measured before the command was measured
+        self.assertIsNotNone(calls[0])
+        self.assertEqual(a1.memory.usage['a'][0], 1)
+
+
 if __name__ == '__main__':
     unittest.main()